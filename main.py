@@ -1,20 +1,52 @@
-from fastapi import FastAPI, HTTPException, status
-from pydantic import BaseModel, EmailStr, Field, validator
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, status
+from pydantic import BaseModel, EmailStr, Field, field_validator
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from fastapi.concurrency import run_in_threadpool
+from typing import Annotated, Optional, List, Union
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import logging
+import logging.handlers
+import queue
+import hashlib
+import uuid
+import secrets
+import re
+from cachetools import TTLCache
+from limits import parse as parse_rate_limit
+from limits.storage import storage_from_string
+from limits.aio.strategies import FixedWindowRateLimiter
 import uvicorn
-from supabase import create_client, Client
+from supabase import create_async_client
+from supabase.lib.client_options import AsyncClientOptions
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
+import httpx
+import orjson
 import bcrypt
 import os
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from urllib.parse import quote
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# --- Logging ---
+# Handlers only enqueue records; a QueueListener thread (started in lifespan)
+# does the actual writes so request handlers never block on stdout
+logger = logging.getLogger("dentist")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+
 # --- Configuration ---
 # REPLACE THESE WITH YOUR ACTUAL SUPABASE CREDENTIALS
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -22,7 +54,8 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in .env file")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# All appointment times are in clinic local time
+IST = ZoneInfo("Asia/Kolkata")
 
 # Google Calendar Configuration
 SCOPES = ['https://www.googleapis.com/auth/calendar']
@@ -32,9 +65,82 @@ SERVICE_ACCOUNT_FILE = 'tonal-shore-434209-q7-fe014e05820d.json'
 # and use your specific Calendar ID (e.g., your gmail address) here.
 CALENDAR_ID = os.getenv("CALENDAR_ID")
 if not CALENDAR_ID:
-    print("WARNING: CALENDAR_ID not found in .env file")
-
-app = FastAPI(title="Dentist Website API")
+    logger.warning("CALENDAR_ID not found in .env file")
+CALENDAR_EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events"
+# Google Calendar accepts at most 50 calls per batch request. Also the cap on
+# one bulk booking request, so it always fits in a single batch.
+CALENDAR_BATCH_SIZE = 50
+
+# Server processes started by `python main.py`
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+# bcrypt processes per server process. The server processes already spread
+# hashing across the cores, so the default is 1; raise it when running few
+# server processes (e.g. WEB_CONCURRENCY=1 with HASH_POOL_WORKERS=<cores>)
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", "1"))
+
+# Outbound HTTP pool shared by Supabase and Google Calendar
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=10)
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=2.0)
+
+# bcrypt work factor; each +1 doubles hashing time (10 ≈ 60 ms, 12 ≈ 250 ms).
+# A stored hash keeps the cost it was created with, so hashes at any other
+# cost are upgraded on the user's next successful login (see rehash_password).
+BCRYPT_COST = int(os.getenv("BCRYPT_COST", "12"))
+
+# Recently verified (password, hash) pairs, so repeat logins skip bcrypt.
+# Keyed on a digest of both, so a password change invalidates the entry.
+LOGIN_CACHE_SIZE = 10_000
+LOGIN_CACHE_TTL = 5 * 60  # seconds
+verified_logins = TTLCache(maxsize=LOGIN_CACHE_SIZE, ttl=LOGIN_CACHE_TTL)
+
+# 10-15 ASCII digits in one regex pass; re.ASCII keeps \d from matching
+# other scripts' digits (e.g. Arabic-Indic), which isdigit() would accept
+PHONE_NUMBER_RE = re.compile(r"\A\d{10,15}\Z", re.ASCII)
+
+# Login rate limits protect the bcrypt CPU budget. Point RATE_LIMIT_STORAGE_URI
+# at Redis (redis://host:6379) so the counters are shared across workers.
+# The limits.aio storages are used so checks never block the event loop.
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+if not RATE_LIMIT_STORAGE_URI.startswith("async+"):
+    RATE_LIMIT_STORAGE_URI = "async+" + RATE_LIMIT_STORAGE_URI
+LOGIN_RATE_LIMIT = parse_rate_limit(os.getenv("LOGIN_RATE_LIMIT", "5/minute"))
+login_rate_limiter = FixedWindowRateLimiter(storage_from_string(RATE_LIMIT_STORAGE_URI))
+# Used while the configured storage is unreachable, so logins stay limited
+# (per worker) instead of failing
+fallback_rate_limiter = FixedWindowRateLimiter(storage_from_string("async+memory://"))
+if WEB_CONCURRENCY > 1 and RATE_LIMIT_STORAGE_URI == "async+memory://":
+    logger.warning(
+        "RATE_LIMIT_STORAGE_URI is memory:// with %d workers; each worker keeps its "
+        "own counters, so login limits are effectively %d times higher",
+        WEB_CONCURRENCY, WEB_CONCURRENCY,
+    )
+
+# Postgres error code raised when an insert hits a UNIQUE constraint
+UNIQUE_VIOLATION = "23505"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+    # One keep-alive connection pool per worker, shared by every request
+    app.state.http = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    app.state.supabase = await create_async_client(
+        SUPABASE_URL, SUPABASE_KEY,
+        options=AsyncClientOptions(httpx_client=app.state.http),
+    )
+    app.state.calendar_creds = load_calendar_credentials()
+    # Built on first use by get_calendar_service()
+    app.state.calendar = None
+    # bcrypt hashing runs in worker processes so bursts use every core
+    app.state.hash_pool = ProcessPoolExecutor(max_workers=HASH_POOL_WORKERS)
+    # Checked against on logins for unknown emails so they cost as much as
+    # real accounts hashed at BCRYPT_COST
+    app.state.dummy_password_hash = await run_in_hash_pool(get_password_hash, secrets.token_urlsafe(16))
+    yield
+    app.state.hash_pool.shutdown()
+    await app.state.http.aclose()
+    log_listener.stop()
+
+app = FastAPI(title="Dentist Website API", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],        # allow all origins
@@ -51,38 +157,251 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     # bcrypt.hashpw expects bytes, returns bytes
     pwd_bytes = password.encode('utf-8')
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_COST)
     return bcrypt.hashpw(pwd_bytes, salt).decode('utf-8')
 
-def get_calendar_service():
+def bcrypt_cost(hashed_password):
+    # '$2b$12$...' -> 12
+    return int(hashed_password.split('$')[2])
+
+async def rehash_password(user_id, plain_password):
+    # Runs as a background task after a login whose stored hash is not at
+    # BCRYPT_COST, so every account converges on the same verify time
+    try:
+        hashed_pwd = await run_in_hash_pool(get_password_hash, plain_password)
+        await (
+            app.state.supabase
+            .table("users")
+            .update({"password_hash": hashed_pwd})
+            .eq("id", user_id)
+            .execute()
+        )
+    except Exception:
+        logger.exception("Password rehash failed for user %s", user_id)
+
+async def run_in_hash_pool(func, *args):
+    # Offload CPU-bound bcrypt work so it never stalls the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.hash_pool, func, *args)
+
+async def check_password(plain_password, hashed_password):
+    key = hashlib.sha256(plain_password.encode('utf-8') + hashed_password.encode('utf-8')).digest()
+    if key in verified_logins:
+        return True
+    if not await run_in_hash_pool(verify_password, plain_password, hashed_password):
+        return False
+    verified_logins[key] = True
+    return True
+
+async def hit_login_rate_limit(*identifiers):
+    # Returns False once the limit for these identifiers is exhausted
+    try:
+        return await login_rate_limiter.hit(LOGIN_RATE_LIMIT, "login", *identifiers)
+    except Exception:
+        logger.warning("Rate limit storage unavailable, falling back to in-memory counters", exc_info=True)
+        return await fallback_rate_limiter.hit(LOGIN_RATE_LIMIT, "login", *identifiers)
+
+def load_calendar_credentials():
+    # Called once at startup; the credentials (and their access token) are reused by every booking
     if not os.path.exists(SERVICE_ACCOUNT_FILE):
-        print("Service account file not found.")
+        logger.warning("Service account file not found. Google Calendar sync disabled.")
         return None
     try:
-        creds = service_account.Credentials.from_service_account_file(
+        from google.oauth2 import service_account
+        return service_account.Credentials.from_service_account_file(
             SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        service = build('calendar', 'v3', credentials=creds)
-        return service
-    except Exception as e:
-        print(f"Error authenticating with Google Calendar: {e}")
+    except Exception:
+        logger.exception("Error authenticating with Google Calendar")
+        return None
+
+def build_calendar_service(creds):
+    # googleapiclient is only used for batch requests (bulk booking)
+    if creds is None:
+        return None
+    try:
+        from googleapiclient.discovery import build
+        # static_discovery loads the calendar v3 discovery document bundled with
+        # google-api-python-client instead of fetching it over HTTPS at startup
+        return build('calendar', 'v3', credentials=creds,
+                     cache_discovery=False, static_discovery=True)
+    except Exception:
+        logger.exception("Error building Google Calendar service")
         return None
 
+def get_calendar_service():
+    # googleapiclient is slow to import and build, so workers that never
+    # handle a bulk booking never pay for it
+    if app.state.calendar is None:
+        app.state.calendar = build_calendar_service(app.state.calendar_creds)
+    return app.state.calendar
+
+def new_calendar_event_id():
+    # Calendar event ids must use base32hex characters (a-v, 0-9); hex qualifies
+    return uuid.uuid4().hex
+
+async def calendar_auth_headers():
+    creds = app.state.calendar_creds
+    if not creds.valid:
+        # Token refresh is a blocking call, but only happens about once an hour
+        await run_in_threadpool(creds.refresh, GoogleAuthRequest())
+    return {"Authorization": f"Bearer {creds.token}"}
+
+async def insert_calendar_event(event_body):
+    response = await app.state.http.post(
+        CALENDAR_EVENTS_URL.format(calendar_id=quote(CALENDAR_ID, safe="")),
+        content=orjson.dumps(event_body),
+        headers={**await calendar_auth_headers(), "Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+    return response.json()
+
+async def sync_appointment_to_calendar(appointment_id, event_body):
+    # Runs as a background task once the booking response has been sent.
+    # If Google fails the appointment simply stays pending.
+    logger.debug("Sending to Google Calendar: %s", event_body)
+    try:
+        event = await insert_calendar_event(event_body)
+        logger.info("Event created: %s", event.get("htmlLink"))
+        await (
+            app.state.supabase
+            .table("appointments")
+            .update({"google_event_id": event.get("id"), "status": "confirmed"})
+            .eq("id", appointment_id)
+            .execute()
+        )
+    except Exception:
+        logger.exception("Google Calendar sync failed for appointment %s", appointment_id)
+
+def insert_calendar_events_batch(event_bodies):
+    # Blocking; sends every insert as one multipart request per CALENDAR_BATCH_SIZE
+    # events and returns the ids of the events that could not be created
+    import google_auth_httplib2
+    import httplib2
+
+    service = get_calendar_service()
+    if service is None:
+        return list(event_bodies)
+    failed = []
+
+    def on_event_inserted(request_id, response, exception):
+        if exception is not None:
+            logger.error("Google Calendar Error (%s): %s", request_id, exception)
+            failed.append(request_id)
+
+    event_ids = list(event_bodies)
+    for i in range(0, len(event_ids), CALENDAR_BATCH_SIZE):
+        chunk = event_ids[i:i + CALENDAR_BATCH_SIZE]
+        batch = service.new_batch_http_request(callback=on_event_inserted)
+        for event_id in chunk:
+            batch.add(
+                service.events().insert(calendarId=CALENDAR_ID, body=event_bodies[event_id]),
+                request_id=event_id,
+            )
+        try:
+            # httplib2.Http is not thread-safe, so each batch gets its own transport
+            batch.execute(http=google_auth_httplib2.AuthorizedHttp(
+                app.state.calendar_creds, http=httplib2.Http()))
+        except Exception:
+            logger.exception("Google Calendar batch insert failed")
+            failed.extend(event_id for event_id in chunk if event_id not in failed)
+    return failed
+
+def parse_appointment_slot(appt):
+    # Raises ValueError on a malformed date or time.
+    # The input is fixed width ('YYYY-MM-DD' + 'HH:MM'), so slice it by hand
+    # rather than paying for strptime's format parsing on every request.
+    d, t = appt.appointment_date, appt.appointment_time
+    digits = d[0:4] + d[5:7] + d[8:10] + t[0:2] + t[3:5]
+    if (len(d) != 10 or d[4] != "-" or d[7] != "-" or len(t) != 5 or t[2] != ":"
+            or not (digits.isascii() and digits.isdigit())):
+        raise ValueError(f"Invalid date or time: {d} {t}")
+
+    start_dt = datetime.datetime(
+        int(d[0:4]), int(d[5:7]), int(d[8:10]), int(t[0:2]), int(t[3:5]), tzinfo=IST
+    )
+    end_dt = start_dt + datetime.timedelta(hours=1)
+    return start_dt, end_dt
+
+def build_calendar_event_body(appt, start_dt, end_dt):
+    return {
+        "summary": f"Dentist Appt: {appt.service} - {appt.full_name}",
+        "location": "T Nagar Dental Clinic",
+        "description": (
+            f"Appointment for {appt.service}\n"
+            f"Patient: {appt.full_name}\n"
+            f"Phone: {appt.phone_number}"
+        ),
+        # IMPORTANT:
+        # ISO string WITH timezone offset (e.g., 2026-03-10T10:00:00+05:30)
+        "start": {
+            "dateTime": start_dt.isoformat(),   # INCLUDES OFFSET (+05:30)
+            # "timeZone": "Asia/Kolkata",   # Not needed if offset is present
+        },
+        "end": {
+            "dateTime": end_dt.isoformat(),     # INCLUDES OFFSET (+05:30)
+            # "timeZone": "Asia/Kolkata",
+        },
+        "reminders": {
+            "useDefault": False,
+            "overrides": [
+                {"method": "email", "minutes": 24 * 60},
+                {"method": "popup", "minutes": 30},
+            ],
+        },
+    }
+
+def build_appointment_row(appt, google_event_id):
+    # Rows always start as pending and are only marked confirmed once their
+    # Calendar event is known to exist, so a failure part-way never leaves
+    # a confirmed row pointing at a missing event
+    return {
+        "full_name": appt.full_name,
+        "phone_number": appt.phone_number,
+        "appointment_date": appt.appointment_date,
+        "appointment_time": appt.appointment_time,
+        "service": appt.service,
+        "google_event_id": google_event_id,
+        "status": "pending",
+    }
+
 # --- Data Models (Pydantic) ---
+# bcrypt only accepts 72 bytes; max_length=72 counts characters, so a
+# multi-byte password can pass it and still make bcrypt raise ValueError
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+def validate_password_bytes(v):
+    if len(v.encode('utf-8')) > BCRYPT_MAX_PASSWORD_BYTES:
+        raise ValueError(f'Password must be at most {BCRYPT_MAX_PASSWORD_BYTES} bytes')
+    return v
+
 class UserRegister(BaseModel):
     full_name: str = Field(..., min_length=2, max_length=100)
     email: EmailStr
     phone_number: str = Field(..., min_length=10)
     password: str = Field(..., min_length=6, max_length=72)
     age: Optional[int] = Field(None, ge=0)
-    @validator('phone_number')
+
+    @field_validator('phone_number')
+    @classmethod
     def validate_phone(cls, v):
-        if not v.isdigit():
-             raise ValueError('Phone number must contain only digits')
+        if not PHONE_NUMBER_RE.match(v):
+             raise ValueError('Phone number must contain only digits (10-15)')
         return v
+
+    @field_validator('password')
+    @classmethod
+    def validate_password(cls, v):
+        return validate_password_bytes(v)
+
 class UserLogin(BaseModel):
     email: EmailStr
     password: str = Field(..., max_length=72)
 
+    @field_validator('password')
+    @classmethod
+    def validate_password(cls, v):
+        return validate_password_bytes(v)
+
 class AppointmentCreate(BaseModel):
     full_name: str
     phone_number: str
@@ -91,24 +410,43 @@ class AppointmentCreate(BaseModel):
     appointment_time: str # Expect 'HH:MM'
     service: str
 
+# Response models: FastAPI serializes these with pydantic-core
+class MessageResponse(BaseModel):
+    message: str
+
+class RegisterResponse(BaseModel):
+    message: str
+    email: str
+
+class LoginResponse(BaseModel):
+    message: str
+    user_id: Union[int, str]
+    email: str
+
+class BookingResponse(BaseModel):
+    message: str
+    appointment_id: Union[int, str]
+    status: str
+
+class BulkBookingResponse(BaseModel):
+    message: str
+    booked: int
+    pending: int
+
 # --- Endpoints ---
 @app.get("/")
-def read_root():
-    return {"message": "Welcome to the Dentist Website API"}
+def read_root() -> MessageResponse:
+    return MessageResponse(message="Welcome to the Dentist Website API")
 
 @app.post("/register", status_code=status.HTTP_201_CREATED)
-def register_user(user: UserRegister):
-    # 1. Check if email exists
+async def register_user(user: UserRegister) -> RegisterResponse:
     try:
-        # Supabase select query
-        existing = supabase.table("users").select("email").eq("email", user.email).execute()
-        if existing.data:
-            raise HTTPException(status_code=400, detail="Email already registered")
-            
-        # 2. Hash password
-        hashed_pwd = get_password_hash(user.password)
+        # 1. Hash password
+        hashed_pwd = await run_in_hash_pool(get_password_hash, user.password)
         
-        # 3. Insert into Supabase
+        # 2. Insert into Supabase
+        # Duplicate emails are rejected by the UNIQUE(email) constraint
+        # (migrations/001_users_email_unique.sql), so no pre-check SELECT is needed
         user_data = {
             "full_name": user.full_name,
             "email": user.email,
@@ -117,176 +455,219 @@ def register_user(user: UserRegister):
             "password_hash": hashed_pwd
         }
         
-        response = supabase.table("users").insert(user_data).execute()
-        
-        # Check for errors in response
-        if not response.data:
-             raise HTTPException(status_code=500, detail="Failed to register user")
-        return {"message": "User registered successfully", "email": user.email}
+        # Nothing from the new row is needed, so skip sending it back;
+        # a failed insert raises APIError
+        await (
+            app.state.supabase
+            .table("users")
+            .insert(user_data, returning=ReturnMethod.minimal)
+            .execute()
+        )
+        return RegisterResponse(message="User registered successfully", email=user.email)
+    except APIError as e:
+        if e.code == UNIQUE_VIOLATION:
+            raise HTTPException(status_code=409, detail="Email already registered")
+        logger.exception("register failed")
+        raise HTTPException(status_code=500, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        # Catch unexpected errors
-        print(f"Error: {e}")
-        if isinstance(e, HTTPException):
-            raise e
-        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/login")
-def login_user(user: UserLogin):
+async def login_user(request: Request, user: UserLogin, background_tasks: BackgroundTasks) -> LoginResponse:
+    # Limited per client IP, and per account so one email can't be hammered
+    # from many addresses
+    client_ip = request.client.host if request.client else "unknown"
+    if not (await hit_login_rate_limit("ip", client_ip)
+            and await hit_login_rate_limit("email", user.email.lower())):
+        raise HTTPException(status_code=429, detail="Too many login attempts, please try again later")
+
     try:
         # 1. Fetch user by email
-        response = supabase.table("users").select("*").eq("email", user.email).execute()
+        # Only the columns login needs; emails are unique so at most one row matches
+        response = await (
+            app.state.supabase
+            .table("users")
+            .select("id,email,password_hash")
+            .eq("email", user.email)
+            .limit(1)
+            .execute()
+        )
         
         if not response.data:
+            # Same bcrypt work as an account hashed at BCRYPT_COST, so response
+            # timing doesn't reveal which emails are registered
+            await run_in_hash_pool(verify_password, user.password, app.state.dummy_password_hash)
             raise HTTPException(status_code=401, detail="Invalid email or password")
             
         user_record = response.data[0]
         
         # 2. Verify password
-        if not verify_password(user.password, user_record["password_hash"]):
+        if not await check_password(user.password, user_record["password_hash"]):
             raise HTTPException(status_code=401, detail="Invalid email or password")
+
+        # 3. Upgrade hashes left over from a different BCRYPT_COST
+        if bcrypt_cost(user_record["password_hash"]) != BCRYPT_COST:
+            background_tasks.add_task(rehash_password, user_record["id"], user.password)
             
-        return {"message": "Login successful", "user_id": user_record["id"], "email": user_record["email"]}
+        return LoginResponse(message="Login successful", user_id=user_record["id"], email=user_record["email"])
         
-    except Exception as e:
-        print(f"Error: {e}")
-        if isinstance(e, HTTPException):
-            raise e
+    except APIError as e:
+        logger.exception("login failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/book-appointment")
-def book_appointment(appt: AppointmentCreate):
+async def book_appointment(appt: AppointmentCreate, background_tasks: BackgroundTasks) -> BookingResponse:
     try:
         # ==============================
         # 1. VALIDATE DATE & TIME (IST)
         # ==============================
         try:
-            ist = pytz.timezone("Asia/Kolkata")
-
-            # Parse input (naive)
-            start_dt_naive = datetime.datetime.strptime(
-                f"{appt.appointment_date} {appt.appointment_time}",
-                "%Y-%m-%d %H:%M"
-            )
-
-            # Localize to IST (CORRECT way)
-            start_dt = ist.localize(start_dt_naive)
-            end_dt = start_dt + datetime.timedelta(hours=1)
-
-            # IMPORTANT:
-            # ISO string WITH timezone offset (e.g., 2026-03-10T10:00:00+05:30)
-            start_iso = start_dt.isoformat()
-            end_iso = end_dt.isoformat()
-
+            start_dt, end_dt = parse_appointment_slot(appt)
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid date or time format")
 
         # ==============================
-        # 2. CHECK CONFLICTS (DB FIRST)
+        # 2. SAVE TO DATABASE
         # ==============================
-        existing_appt = (
-            supabase
-            .table("appointments")
-            .select("*")
-            .eq("appointment_date", appt.appointment_date)
-            .eq("appointment_time", appt.appointment_time)
-            .neq("status", "cancelled")
-            .execute()
-        )
+        # Double bookings are rejected by the partial unique index on
+        # (appointment_date, appointment_time), see migrations/002_appointments_slot_unique.sql
+        appt_data = build_appointment_row(appt, None)
 
-        if existing_appt.data:
+        try:
+            # Full row returned: its id is needed for the background Calendar sync
+            response = await app.state.supabase.table("appointments").insert(appt_data).execute()
+        except APIError as e:
+            if e.code != UNIQUE_VIOLATION:
+                raise
             next_slot = start_dt + datetime.timedelta(hours=1)
             next_slot_str = next_slot.strftime("%H:%M")
 
             raise HTTPException(
-                status_code=400,
+                status_code=409,
                 detail=f"Time slot {appt.appointment_time} is already booked. "
                        f"Please try {next_slot_str} or another time."
             )
 
+        if not response.data:
+            raise HTTPException(status_code=500, detail="Failed to save appointment")
+        appointment_id = response.data[0]["id"]
+
         # ==============================
-        # 3. GOOGLE CALENDAR EVENT BODY
+        # 3. CREATE GOOGLE EVENT (Admin Calendar, after the response is sent)
         # ==============================
-        calendar_event_body = {
-            "summary": f"Dentist Appt: {appt.service} - {appt.full_name}",
-            "location": "T Nagar Dental Clinic",
-            "description": (
-                f"Appointment for {appt.service}\n"
-                f"Patient: {appt.full_name}\n"
-                f"Phone: {appt.phone_number}"
-            ),
-            "start": {
-                "dateTime": start_iso,          # INCLUDES OFFSET (+05:30)
-                # "timeZone": "Asia/Kolkata",   # Not needed if offset is present
-            },
-            "end": {
-                "dateTime": end_iso,            # INCLUDES OFFSET (+05:30)
-                # "timeZone": "Asia/Kolkata",
-            },
-            "reminders": {
-                "useDefault": False,
-                "overrides": [
-                    {"method": "email", "minutes": 24 * 60},
-                    {"method": "popup", "minutes": 30},
-                ],
-            },
-        }
+        if app.state.calendar_creds:
+            calendar_event_body = build_calendar_event_body(appt, start_dt, end_dt)
+            background_tasks.add_task(sync_appointment_to_calendar, appointment_id, calendar_event_body)
+
+        return BookingResponse(
+            message="Appointment booked successfully",
+            appointment_id=appointment_id,
+            status=appt_data["status"],
+        )
 
+    except APIError:
+        logger.exception("booking failed")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/book-appointments/bulk")
+async def book_appointments_bulk(
+    appts: Annotated[List[AppointmentCreate], Field(max_length=CALENDAR_BATCH_SIZE)],
+) -> BulkBookingResponse:
+    if not appts:
+        raise HTTPException(status_code=400, detail="No appointments provided")
+    try:
         # ==============================
-        # 4. CREATE GOOGLE EVENT (Admin Calendar)
+        # 1. VALIDATE DATES & TIMES (IST)
         # ==============================
-        service = get_calendar_service()
-        google_event_id = None
-        
-        print(f"DEBUG: Sending to Google Calendar: {calendar_event_body}")
-
-        if service:
+        slots = []
+        for appt in appts:
             try:
-                event = (
-                    service.events()
-                    .insert(calendarId=CALENDAR_ID, body=calendar_event_body)
-                    .execute()
+                slots.append(parse_appointment_slot(appt))
+            except ValueError:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid date or time format: {appt.appointment_date} {appt.appointment_time}"
                 )
-                google_event_id = event.get("id")
-                print(f"Event created: {event.get('htmlLink')}")
-
-            except Exception as google_err:
-                print("Google Calendar Error:", google_err)
-                # DB still wins — continue
 
         # ==============================
-        # 5. SAVE TO DATABASE
+        # 2. SAVE TO DATABASE (ONE INSERT)
         # ==============================
-        appt_data = {
-            "full_name": appt.full_name,
-            "phone_number": appt.phone_number,
-            "appointment_date": appt.appointment_date,
-            "appointment_time": appt.appointment_time,
-            "service": appt.service,
-            "google_event_id": google_event_id,
-            "status": "confirmed" if google_event_id else "pending",
-        }
+        # The insert is all-or-nothing: any slot that is already taken (or
+        # repeated in the request) fails the whole batch on the unique index
+        calendar_enabled = app.state.calendar_creds is not None
+        event_bodies = {}
+        rows = []
+        for appt, (start_dt, end_dt) in zip(appts, slots):
+            google_event_id = None
+            if calendar_enabled:
+                google_event_id = new_calendar_event_id()
+                event_bodies[google_event_id] = build_calendar_event_body(appt, start_dt, end_dt)
+                event_bodies[google_event_id]["id"] = google_event_id
+            rows.append(build_appointment_row(appt, google_event_id))
 
-        response = supabase.table("appointments").insert(appt_data).execute()
+        try:
+            # Rows are matched up again by google_event_id, not by anything
+            # returned here, so skip sending them back
+            await (
+                app.state.supabase
+                .table("appointments")
+                .insert(rows, returning=ReturnMethod.minimal)
+                .execute()
+            )
+        except APIError as e:
+            if e.code == UNIQUE_VIOLATION:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"One or more time slots are already booked. {e.details or ''}".strip()
+                )
+            raise
 
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Failed to save appointment")
+        # ==============================
+        # 3. CREATE GOOGLE EVENTS (BATCHED)
+        # ==============================
+        failed_event_ids = []
+        if event_bodies:
+            failed_event_ids = await run_in_threadpool(insert_calendar_events_batch, event_bodies)
+        confirmed_event_ids = [event_id for event_id in event_bodies if event_id not in failed_event_ids]
+
+        if confirmed_event_ids:
+            await (
+                app.state.supabase
+                .table("appointments")
+                .update({"status": "confirmed"})
+                .in_("google_event_id", confirmed_event_ids)
+                .execute()
+            )
 
-        return {
-            "message": "Appointment booked successfully",
-            "google_event_link": (
-                f"https://www.google.com/calendar/event?eid={google_event_id}"
-                if google_event_id else None
-            ),
-        }
+        if failed_event_ids:
+            # DB still wins — those bookings stay pending, just drop the
+            # ids of the events that were never created
+            await (
+                app.state.supabase
+                .table("appointments")
+                .update({"google_event_id": None})
+                .in_("google_event_id", failed_event_ids)
+                .execute()
+            )
 
-    except HTTPException:
-        raise
+        return BulkBookingResponse(
+            message="Appointments booked successfully",
+            booked=len(rows),
+            pending=len(rows) - len(confirmed_event_ids),
+        )
 
-    except Exception as e:
-        print("Booking Error:", e)
+    except APIError:
+        logger.exception("bulk booking failed")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    # Production: gunicorn -k uvicorn.workers.UvicornWorker -w $((2 * $(nproc) + 1)) main:app
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        reload=False,
+    )
\ No newline at end of file
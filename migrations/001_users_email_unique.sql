@@ -0,0 +1,4 @@
+-- Registration relies on this constraint to reject duplicate emails in a
+-- single INSERT (Postgres error 23505) instead of a SELECT + INSERT.
+ALTER TABLE users
+    ADD CONSTRAINT users_email_key UNIQUE (email);
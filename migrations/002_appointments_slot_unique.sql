@@ -0,0 +1,7 @@
+-- Booking relies on this index to reject double bookings in a single
+-- INSERT (Postgres error 23505) instead of a SELECT + INSERT, which also
+-- closes the race between concurrent bookings for the same slot.
+-- Cancelled appointments do not hold their slot.
+CREATE UNIQUE INDEX appointments_slot_key
+    ON appointments (appointment_date, appointment_time)
+    WHERE status <> 'cancelled';